@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 from subprocess import Popen, PIPE
 
 import yaml
@@ -157,7 +158,24 @@ def pull():
         if env.conf['vcs'] is 'svn':
             run('svn up %s' % env.conf['repos_url'])
 
-        delete_pyc()
+    precompile()
+    reload()
+
+
+@task
+def rollback():
+    """
+    Switch back to the previous release (keep_releases must be set).
+    """
+    with cd(env.project_dir + '_releases'):
+        current = run('basename $(readlink current)')
+        releases = sorted(r for r in run('ls -1').split() if r.isdigit())
+        if current not in releases or releases.index(current) == 0:
+            print "No release older than %s to roll back to" % current
+            return
+        previous = releases[releases.index(current) - 1]
+        sudo('ln -s %s current.tmp && mv -T current.tmp current' %
+             os.path.join(env.project_dir + '_releases', previous))
     reload()
 
 
@@ -188,6 +206,20 @@ def load_fixture(fixture_path):
     run('rm %s' % os.path.join('/tmp/', fixture_file))
 
 # Utils
+@task
+def precompile():
+    """ Compiles the sources newer than their *.pyc files and removes stale *.pyc """
+    start = time.time()
+    with cd(env.project_dir):
+        stamp = run('mktemp')
+        sudo("find -L . -name '*.pyc' | while read f; do "
+             "[ -e \"${f%c}\" ] || rm -f \"$f\"; done", user=env.conf['wsgi_user'])
+        sudo("python -m compileall -q -x '/[.](git|hg|bzr|svn)/' .",
+             user=env.conf['wsgi_user'])
+        compiled = run("find -L . -name '*.pyc' -newer %s | wc -l" % stamp)
+        run('rm -f %s' % stamp)
+    print "Compiled %s files in %.2fs" % (compiled.strip(), time.time() - start)
+
 @task
 def delete_pyc():
     """ Deletes *.pyc files from project source dir """
@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 # vim: et ai ts=4 sw=4:
 
+import atexit
+import glob
+import gzip
+import hashlib
+import imp
 import json
+import marshal
 import os
+import py_compile
 import re
+import shutil
 import subprocess
 import sys
+import threading
 import time
 from pwd import getpwnam
 from grp import getgrnam
 from random import choice
 
 CHARM_PACKAGES = ["python-pip", "python-jinja2", "mercurial", "git-core",
-                  "subversion", "bzr", "gettext"]
+                  "subversion", "bzr", "gettext", "python-virtualenv"]
 
 INJECTED_WARNING = """
 #------------------------------------------------------------------------------
@@ -30,9 +39,45 @@ MSG_INFO = "INFO"
 MSG_ERROR = "ERROR"
 MSG_WARNING = "WARNING"
 
+MSG_PRIORITIES = {MSG_DEBUG: 10, MSG_INFO: 20, MSG_WARNING: 30,
+                  MSG_ERROR: 40, MSG_CRITICAL: 50}
+LOG_BUFFER_SIZE = 50
 
+log_threshold = MSG_INFO
+_log_buffer = []
+_log_lock = threading.RLock()
+
+
+#------------------------------------------------------------------------------
+# juju_log:  Queues a message for juju-log if its level reaches the
+#            threshold. Messages are sent in batches by juju_log_flush(),
+#            right away for errors and at the latest when the hook exits.
+#------------------------------------------------------------------------------
 def juju_log(level, msg):
-    subprocess.call(['juju-log', '-l', level, msg])
+    priority = MSG_PRIORITIES.get(level, MSG_PRIORITIES[MSG_INFO])
+    if priority < MSG_PRIORITIES.get(log_threshold, 0):
+        return
+    with _log_lock:
+        _log_buffer.append((level, msg))
+        if priority >= MSG_PRIORITIES[MSG_ERROR] or \
+           len(_log_buffer) >= LOG_BUFFER_SIZE:
+            juju_log_flush()
+
+
+#------------------------------------------------------------------------------
+# juju_log_flush:  Sends the queued messages, one juju-log call per run of
+#                  messages sharing the same level
+#------------------------------------------------------------------------------
+def juju_log_flush():
+    with _log_lock:
+        while _log_buffer:
+            level = _log_buffer[0][0]
+            batch = []
+            while _log_buffer and _log_buffer[0][0] == level:
+                batch.append(_log_buffer.pop(0)[1])
+            subprocess.call(['juju-log', '-l', level, '\n'.join(batch)])
+
+atexit.register(juju_log_flush)
 
 #------------------------------------------------------------------------------
 # run: Run a command, return the output
@@ -113,6 +158,36 @@ def relation_json(scope=None, unit_name=None, relation_id=None):
     return output or None
 
 
+#------------------------------------------------------------------------------
+# Relation snapshot: relation-ids, relation-list and relation-get results are
+#                    fetched once per hook run and served from memory
+#                    afterwards. relation_set() invalidates what it touches.
+#------------------------------------------------------------------------------
+_relation_snapshot = {'ids': {}, 'units': {}, 'settings': {}}
+
+
+def relation_cache_clear(relation_id=None):
+    if relation_id is None:
+        for cache in _relation_snapshot.values():
+            cache.clear()
+        return
+    _relation_snapshot['units'].pop(relation_id, None)
+    for key in _relation_snapshot['settings'].keys():
+        if key[0] == relation_id:
+            del _relation_snapshot['settings'][key]
+
+
+#------------------------------------------------------------------------------
+# relation_settings:  Returns every setting a unit published on a relation
+#------------------------------------------------------------------------------
+def relation_settings(relation_id, unit_name):
+    key = (relation_id, unit_name)
+    if key not in _relation_snapshot['settings']:
+        j = relation_json(unit_name=unit_name, relation_id=relation_id)
+        _relation_snapshot['settings'][key] = json.loads(j or '{}') or {}
+    return _relation_snapshot['settings'][key]
+
+
 #------------------------------------------------------------------------------
 # relation_get:  Returns a dictionary containing the relation information
 #                Optional parameters: scope, relation_id
@@ -122,19 +197,57 @@ def relation_json(scope=None, unit_name=None, relation_id=None):
 #                              to the specified unit
 #------------------------------------------------------------------------------
 def relation_get(scope=None, unit_name=None, relation_id=None):
-    j = relation_json(scope, unit_name, relation_id)
-    if j:
-        return json.loads(j)
-    else:
-        return None
+    relid = relation_id or os.environ.get('JUJU_RELATION_ID')
+    unit = unit_name or os.environ.get('JUJU_REMOTE_UNIT')
+    if not relid or not unit:
+        # No remote unit to snapshot (e.g. a -broken hook), ask juju directly
+        j = relation_json(scope, unit_name, relation_id)
+        if j:
+            return json.loads(j)
+        else:
+            return None
+    settings = relation_settings(relid, unit)
+    if scope is not None:
+        return settings.get(scope)
+    return dict(settings) or None
+
+
+#------------------------------------------------------------------------------
+# relation_set:  Queues settings to publish on a relation. Writes are buffered
+#                for the whole hook and sent by relation_flush(), one
+#                relation-set per relation id.
+#------------------------------------------------------------------------------
+_relation_writes = {}
 
 
 def relation_set(keyvalues, relation_id=None):
+    relid = relation_id or os.environ.get('JUJU_RELATION_ID')
+    _relation_writes.setdefault(relid, {}).update(keyvalues)
+
+
+#------------------------------------------------------------------------------
+# relation_flush:  Publishes the queued settings, skipping the keys whose
+#                  value is already the one this unit published
+#------------------------------------------------------------------------------
+def relation_flush():
+    local_unit = os.environ['JUJU_UNIT_NAME']
+    for relid, keyvalues in sorted(_relation_writes.items()):
+        if relid is not None:
+            published = relation_settings(relid, local_unit)
+            keyvalues = dict((k, v) for k, v in keyvalues.items()
+                             if '{}'.format(v or '') != published.get(k, ''))
+        if keyvalues:
+            relation_set_now(keyvalues, relid)
+    _relation_writes.clear()
+
+
+def relation_set_now(keyvalues, relation_id=None):
     args = []
     if relation_id:
         args.extend(['-r', relation_id])
     args.extend(["{}='{}'".format(k, v or '') for k, v in keyvalues.items()])
     run("relation-set {}".format(' '.join(args)))
+    relation_cache_clear(relation_id or os.environ.get('JUJU_RELATION_ID'))
 
     ## Posting json to relation-set doesn't seem to work as documented?
     ## Bug #1116179
@@ -156,11 +269,12 @@ def relation_list(relation_id=None):
     """Return the list of units participating in the relation."""
     if relation_id is None:
         relation_id = os.environ['JUJU_RELATION_ID']
-    cmd = ['relation-list', '--format=json', '-r', relation_id]
-    json_units = subprocess.check_output(cmd).strip()
-    if json_units:
-        return json.loads(subprocess.check_output(cmd))
-    return []
+    if relation_id not in _relation_snapshot['units']:
+        cmd = ['relation-list', '--format=json', '-r', relation_id]
+        json_units = subprocess.check_output(cmd).strip()
+        _relation_snapshot['units'][relation_id] = \
+            json.loads(json_units) if json_units else []
+    return list(_relation_snapshot['units'][relation_id] or [])
 
 
 #------------------------------------------------------------------------------
@@ -176,10 +290,12 @@ def relation_ids(relation_types=('db',)):
         reltypes = relation_types
     relids = []
     for reltype in reltypes:
-        relid_cmd_line = ['relation-ids', '--format=json', reltype]
-        json_relids = subprocess.check_output(relid_cmd_line).strip()
-        if json_relids:
-            relids.extend(json.loads(json_relids))
+        if reltype not in _relation_snapshot['ids']:
+            relid_cmd_line = ['relation-ids', '--format=json', reltype]
+            json_relids = subprocess.check_output(relid_cmd_line).strip()
+            _relation_snapshot['ids'][reltype] = \
+                json.loads(json_relids) if json_relids else []
+        relids.extend(_relation_snapshot['ids'][reltype] or [])
     return relids
 
 
@@ -193,46 +309,96 @@ def relation_get_all(*args, **kwargs):
     relation_data = []
     relids = relation_ids(*args, **kwargs)
     for relid in relids:
-        units_cmd_line = ['relation-list', '--format=json', '-r', relid]
-        json_units = subprocess.check_output(units_cmd_line).strip()
-        if json_units:
-            for unit in json.loads(json_units):
-                unit_data = \
-                    json.loads(relation_json(relation_id=relid,
-                        unit_name=unit))
-                for key in unit_data:
-                    if key.endswith('-list'):
-                        unit_data[key] = unit_data[key].split()
-                unit_data['relation-id'] = relid
-                unit_data['unit'] = unit
-                relation_data.append(unit_data)
+        for unit in relation_list(relid):
+            unit_data = dict(relation_settings(relid, unit))
+            for key in unit_data:
+                if key.endswith('-list'):
+                    unit_data[key] = unit_data[key].split()
+            unit_data['relation-id'] = relid
+            unit_data['unit'] = unit
+            relation_data.append(unit_data)
     return relation_data
 
 def apt_get_update():
     cmd_line = ['apt-get', 'update']
-    return(subprocess.call(cmd_line))
+    with _apt_lock:
+        return(subprocess.call(cmd_line))
+
+
+#------------------------------------------------------------------------------
+# installed_packages:  Returns the set of installed packages, read from the
+#                      dpkg database once per hook run
+#------------------------------------------------------------------------------
+_installed_packages = None
+# Serializes the apt-get calls of the install phases running in parallel
+_apt_lock = threading.RLock()
+
+
+def installed_packages():
+    global _installed_packages
+    if _installed_packages is None:
+        output = subprocess.check_output(
+            ['dpkg-query', '-W', '-f=${Package} ${Status}\n'])
+        _installed_packages = set(line.split()[0]
+                                  for line in output.splitlines()
+                                  if line.endswith(' installed'))
+    return _installed_packages
 
 
 #------------------------------------------------------------------------------
-# apt_get_install( packages ):  Installs package(s)
+# apt_get_install( packages ):  Installs the package(s) that are missing, in
+#                               a single apt-get call. Retries with an
+#                               exponential backoff while dpkg is locked.
+#                               upgrade: also pass the installed ones so
+#                                        apt-get upgrades them.
 #------------------------------------------------------------------------------
-def apt_get_install(packages=None):
+APT_LOCK_MAX_DELAY = 128
+APT_LOCK_ERRORS = re.compile('Could not get lock|Unable to lock|'
+                             'Unable to acquire the dpkg')
+
+
+def apt_get_install(packages=None, upgrade=False):
     if packages is None:
         return(False)
+    if not isinstance(packages, list):
+        packages = [packages]
+    with _apt_lock:
+        return _apt_get_install(packages, upgrade)
+
+
+def _apt_get_install(packages, upgrade):
+    missing = [p for p in packages
+               if upgrade or p not in installed_packages()]
+    if not missing:
+        return(0)
     cmd_line = ['apt-get', '-y', 'install', '-qq']
-    if isinstance(packages, list):
-        cmd_line.extend(packages)
-    else:
-        cmd_line.append(packages)
-    return(subprocess.call(cmd_line))
+    cmd_line.extend(missing)
+    delay = 1
+    while True:
+        p = subprocess.Popen(cmd_line, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if p.returncode == 0:
+            installed_packages().update(missing)
+            return(0)
+        if not APT_LOCK_ERRORS.search(output) or delay > APT_LOCK_MAX_DELAY:
+            juju_log(MSG_ERROR, "apt-get install failed: %s" % output)
+            return(p.returncode)
+        juju_log(MSG_INFO, "dpkg is locked, retrying in %ds" % delay)
+        time.sleep(delay)
+        delay *= 2
 
 
 #------------------------------------------------------------------------------
 # pip_install( package ):  Installs a python package
 #------------------------------------------------------------------------------
+# Switched to a release virtualenv's pip while that release is being built
+pip_executable = 'pip'
+
+
 def pip_install(packages=None, upgrade=False):
     # Build in /tmp or Juju's internal git will be confused
-    cmd_line = ['pip', 'install', '-b', '/tmp/']
+    cmd_line = [pip_executable, 'install', '-b', '/tmp/']
     if packages is None:
         return(False)
     if upgrade:
@@ -254,7 +420,7 @@ def pip_install(packages=None, upgrade=False):
 #------------------------------------------------------------------------------
 def pip_install_req(path=None, upgrade=False):
     # Build in /tmp or Juju's internal git will be confused
-    cmd_line = ['pip', 'install', '-b', '/tmp/']
+    cmd_line = [pip_executable, 'install', '-b', '/tmp/']
     if path is None:
         return(False)
     if upgrade:
@@ -265,6 +431,101 @@ def pip_install_req(path=None, upgrade=False):
     cmd_line.append('--use-mirrors')
     return(subprocess.call(cmd_line, cwd=cwd))
 
+#------------------------------------------------------------------------------
+# pip_frozen:  Returns the installed python distributions, as reported by
+#              pip freeze, in a {normalized name: version} dictionary
+#------------------------------------------------------------------------------
+def pip_name(name):
+    return name.strip().lower().replace('_', '-')
+
+
+def pip_frozen():
+    frozen = {}
+    for line in subprocess.check_output([pip_executable, 'freeze']).splitlines():
+        if '==' in line:
+            name, version = line.split('==', 1)
+            frozen[pip_name(name)] = version.strip()
+    return frozen
+
+
+#------------------------------------------------------------------------------
+# pip_missing( packages ):  Returns the packages pip freeze doesn't satisfy.
+#                           Anything other than "name" or "name==version"
+#                           (VCS urls, version ranges) is left to pip.
+#------------------------------------------------------------------------------
+def pip_missing(packages):
+    if not packages:
+        return []
+    frozen = pip_frozen()
+    missing = []
+    for package in packages:
+        m = re.match(r'^([A-Za-z0-9_.\-]+)\s*(?:==\s*(\S+))?$', package.strip())
+        if m is None or pip_name(m.group(1)) not in frozen or \
+           (m.group(2) and frozen[pip_name(m.group(1))] != m.group(2)):
+            missing.append(package)
+    return missing
+
+
+#------------------------------------------------------------------------------
+# pip fingerprints:  Hashes of the requirement files and of the
+#                    additional_pip_packages list, as of the last successful
+#                    pip run, so upgrades only install what changed
+#------------------------------------------------------------------------------
+def pip_requirements_changed(paths):
+    known = state_get('pip_fingerprints', {})
+    return [path for path in paths
+            if os.path.exists(path) and file_hash(path) != known.get(path)]
+
+
+def pip_packages_changed(packages):
+    known = state_get('pip_fingerprints', {})
+    return content_hash(packages) != known.get('additional_pip_packages')
+
+
+def pip_requirements_record(paths=(), packages=None):
+    known = state_get('pip_fingerprints', {})
+    known.update((path, file_hash(path)) for path in paths
+                 if os.path.exists(path))
+    if packages is not None:
+        known['additional_pip_packages'] = content_hash(packages)
+    state_set({'pip_fingerprints': known})
+
+
+#------------------------------------------------------------------------------
+# pip_install_wheelhouse( wheelhouse, req_files, packages ):
+#       Installs requirement files and packages in a single pip call using only
+#       the wheels found in wheelhouse. When some are missing, builds every
+#       wheel into wheelhouse first (this needs the index) and tries again.
+#------------------------------------------------------------------------------
+def pip_install_wheelhouse(wheelhouse, req_files=(), packages=(),
+                           upgrade=False):
+    args = []
+    cwd = None
+    for path in req_files:
+        if os.path.exists(path):
+            args.extend(['-r', path])
+            cwd = cwd or os.path.dirname(path)
+    args.extend(packages)
+    if not args:
+        return(False)
+
+    # Build in /tmp or Juju's internal git will be confused
+    install_cmd = [pip_executable, 'install', '-b', '/tmp/', '--no-index',
+                   '--find-links', wheelhouse]
+    if upgrade:
+        install_cmd.append('--upgrade')
+    if os.path.isdir(wheelhouse) and \
+       subprocess.call(install_cmd + args, cwd=cwd) == 0:
+        return(0)
+
+    juju_log(MSG_INFO, "Building wheels into %s" % wheelhouse)
+    if not os.path.isdir(wheelhouse):
+        os.makedirs(wheelhouse)
+    pip_install('wheel')
+    subprocess.call([pip_executable, 'wheel', '-b', '/tmp/', '--wheel-dir', wheelhouse,
+                     '--use-mirrors'] + args, cwd=cwd)
+    return(subprocess.call(install_cmd + args, cwd=cwd))
+
 #------------------------------------------------------------------------------
 # open_port:  Convenience function to open a port in juju to
 #             expose a service
@@ -349,18 +610,60 @@ def get_unit_host():
     this_host = run("unit-get private-address")
     return this_host.strip()
 
+#------------------------------------------------------------------------------
+# template_env:  Returns the Jinja2 environment shared by every render of the
+#                hook run. Compiled templates are kept in a bytecode cache
+#                so later hooks don't parse them again.
+#------------------------------------------------------------------------------
+_template_env = None
+
+
+def template_env():
+    global _template_env
+    if _template_env is None:
+        from jinja2 import (Environment, FileSystemLoader,
+                            FileSystemBytecodeCache)
+        cache_dir = os.path.join(os.environ['CHARM_DIR'], '.template-cache')
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _template_env = Environment(
+            loader=FileSystemLoader(os.path.join(os.environ['CHARM_DIR'],
+            'templates')),
+            bytecode_cache=FileSystemBytecodeCache(cache_dir))
+    return _template_env
+
+
+def render_template(template_name, template_vars):
+    return str(template_env().get_template(template_name).render(template_vars))
+
+
+def content_hash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+
+def file_hash(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return content_hash(f.read())
+
+
+#------------------------------------------------------------------------------
+# process_template:  Renders a template to destination. The file is only
+#                    rewritten when the rendered content differs from what is
+#                    on disk. Returns True if the file changed.
+#------------------------------------------------------------------------------
 def process_template(template_name, template_vars, destination):
     # --- exported service configuration file
-    from jinja2 import Environment, FileSystemLoader
-    template_env = Environment(
-        loader=FileSystemLoader(os.path.join(os.environ['CHARM_DIR'],
-        'templates')))
+    template = render_template(template_name, template_vars)
 
-    template = \
-        template_env.get_template(template_name).render(template_vars)
+    if file_hash(destination) == content_hash(template):
+        return False
 
     with open(destination, 'w') as inject_file:
-        inject_file.write(str(template))
+        inject_file.write(template)
+    own_path(destination)
+    return True
 
 def configure_and_install(rel):
 
@@ -376,24 +679,30 @@ def configure_and_install(rel):
         return apt_get_install("python-django")
     elif rel[:4] == "ppa:":
         src = rel
-        subprocess.check_call(["add-apt-repository", "-y", src])
+        # Holds the apt lock so the distro_packages phase doesn't run
+        # apt-get while the sources are being changed
+        with _apt_lock:
+            subprocess.check_call(["add-apt-repository", "-y", src])
 
-        return apt_get_install("python-django")
+            return apt_get_install("python-django")
     elif rel[:3] == "deb":
         l = len(rel.split('|'))
-        if l ==  2:
-            src, key = rel.split('|')
-            juju_log("Importing PPA key from keyserver for %s" % src)
-            _import_key(key)
-        elif l == 1:
-            src = rel
-        else:
-            juju_log(MSG_ERROR, "Invalid django-release: %s" % rel)
-
-        with open('/etc/apt/sources.list.d/juju_python_django_deb.list', 'w') as f:
-            f.write(src)
-
-        return apt_get_install("python-django")
+        with _apt_lock:
+            if l ==  2:
+                src, key = rel.split('|')
+                juju_log(MSG_INFO,
+                         "Importing PPA key from keyserver for %s" % src)
+                _import_key(key)
+            elif l == 1:
+                src = rel
+            else:
+                juju_log(MSG_ERROR, "Invalid django-release: %s" % rel)
+
+            with open('/etc/apt/sources.list.d/juju_python_django_deb.list',
+                      'w') as f:
+                f.write(src)
+
+            return apt_get_install("python-django")
     elif rel == '':
         return pip_install('Django')
     else:
@@ -415,6 +724,12 @@ def which(program):
 
     return False
 
+def requirements_pip_paths(project_dir=None):
+    if not requirements_pip_files:
+        return []
+    return [os.path.join(project_dir or working_dir, req_file)
+            for req_file in requirements_pip_files.split(',')]
+
 def find_django_admin_cmd():
     for cmd in ['django-admin.py', 'django-admin']:
         django_admin_cmd = which(cmd)
@@ -423,115 +738,1194 @@ def find_django_admin_cmd():
 
     juju_log(MSG_ERROR, "No django-admin executable found.")
 
+#------------------------------------------------------------------------------
+# append_template:  Appends a rendered template to path unless it is already
+#                   there. Returns True if the file changed.
+#------------------------------------------------------------------------------
 def append_template(template_name, template_vars, path, try_append=False):
 
     # --- exported service configuration file
-    from jinja2 import Environment, FileSystemLoader
-    template_env = Environment(
-        loader=FileSystemLoader(os.path.join(os.environ['CHARM_DIR'],
-        'templates')))
-
-    template = \
-        template_env.get_template(template_name).render(template_vars)
+    template = render_template(template_name, template_vars)
 
-    append = False
+    content = ''
     if os.path.exists(path):
         with open(path, 'r') as inject_file:
-            if not str(template) in inject_file:
-                append = True
-    else:       
-        append = True
-        
-    if append == True:
+            content = inject_file.read()
+    if template in content:
+        return False
+
+    # An older version of the import code is replaced rather than run twice
+    if INJECTED_WARNING in content:
+        with open(path, 'w') as inject_file:
+            inject_file.write(content[:content.index(INJECTED_WARNING)])
+            inject_file.write(INJECTED_WARNING)
+            inject_file.write(template)
+    else:
         with open(path, 'a') as inject_file:
             inject_file.write(INJECTED_WARNING)
-            inject_file.write(str(template))
+            inject_file.write(template)
+    own_path(path)
+    return True
 
 
+#------------------------------------------------------------------------------
+# Settings bundles:  The fragments of the settings and urls directories are
+#                    compiled into one marshalled bundle beside the directory,
+#                    which the injected import code runs instead of globbing
+#                    and compiling every fragment on each import. Rebuilt at
+#                    the end of the hook when a fragment is newer than it.
+#------------------------------------------------------------------------------
+def settings_bundle_path(dir_path):
+    return os.path.join(os.path.dirname(dir_path),
+                        '.%s.bundle' % os.path.basename(dir_path))
 
-###############################################################################
-# Hook functions
-###############################################################################
-def install():
 
-    for retry in xrange(0,24):
-        if apt_get_install(CHARM_PACKAGES):
-            time.sleep(10)
-        else:
-            break
+def build_settings_bundle(dir_path):
+    if not os.path.isdir(dir_path):
+        return False
+    bundle_path = settings_bundle_path(dir_path)
+    fragments = sorted(glob.glob(os.path.join(dir_path, '*.py')))
+    if os.path.exists(bundle_path):
+        built = os.path.getmtime(bundle_path)
+        if all(os.path.getmtime(p) < built for p in [dir_path] + fragments):
+            return False
+
+    codes = []
+    for path in fragments:
+        with open(path, 'r') as fragment:
+            try:
+                codes.append(compile(fragment.read(), os.path.abspath(path), 'exec'))
+            except SyntaxError, e:
+                # Leave the import code to report it from source
+                juju_log(MSG_ERROR, "Not bundling %s: %s" % (dir_path, e))
+                if os.path.exists(bundle_path):
+                    os.remove(bundle_path)
+                return False
+
+    with open(bundle_path + '.tmp', 'wb') as bundle:
+        bundle.write(imp.get_magic())
+        # The import code checks the names recorded instead of globbing
+        marshal.dump(([os.path.basename(p) for p in fragments], codes), bundle)
+    os.rename(bundle_path + '.tmp', bundle_path)
+    own_path(bundle_path)
+    juju_log(MSG_DEBUG, "Bundled %d fragments of %s" % (len(codes), dir_path))
+    return True
 
-    configure_and_install(django_version)
 
-    django_admin_cmd = find_django_admin_cmd()
-            
-    if extra_deb_pkgs:
-        apt_get_install(extra_deb_pkgs.split(','))
+def settings_bundle_flush():
+    for dir_path in (settings_dir_path, urls_dir_path):
+        build_settings_bundle(dir_path)
 
-    if extra_pip_pkgs:
-        for package in extra_pip_pkgs.split(','):
-            pip_install(package)
 
-    if repos_username:
-        m = re.match(".*://([^/]+)/.*", repos_url)
-        if m is not None:
-            repos_domain = m.group(1)
-            template_vars = {
-                'repos_domain': repos_domain,
-                'repos_username': repos_username,
-                'repos_password': repos_password
-            }
-            from os.path import expanduser
-            process_template('netrc.tmpl', template_vars, expanduser('~/.netrc'))
-        else:
-            juju_log(MSG_ERROR, '''Failed to process repos_username and repos_password:\n
-                                   cannot identify domain in URL {0}'''.format(repos_url))
-        
+
+#------------------------------------------------------------------------------
+# Ownership:  Files the charm writes in the project are recorded with
+#             own_path() and handed to the wsgi user by ownership_flush() at
+#             the end of the hook. chown_tree() walks a whole tree, for after
+#             VCS operations, and only touches paths with the wrong owner.
+#------------------------------------------------------------------------------
+_owned_paths = set()
+
+
+def wsgi_ids():
+    return getpwnam(wsgi_user)[2], getgrnam(wsgi_group)[2]
+
+
+def chown_if_needed(path, uid, gid):
+    st = os.lstat(path)
+    if st.st_uid != uid or st.st_gid != gid:
+        os.lchown(path, uid, gid)
+        return True
+    return False
+
+
+def chown_tree(root):
+    if not os.path.isdir(root):
+        return
+    uid, gid = wsgi_ids()
+    fixed = int(chown_if_needed(root, uid, gid))
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            fixed += chown_if_needed(os.path.join(dirpath, name), uid, gid)
+    juju_log(MSG_DEBUG, "Fixed ownership of %d paths in %s" % (fixed, root))
+
+
+def own_path(path):
+    path_abs, working_abs = os.path.abspath(path), os.path.abspath(working_dir)
+    if path_abs == working_abs or path_abs.startswith(working_abs + os.sep):
+        _owned_paths.add(path)
+
+
+def ownership_flush():
+    uid, gid = wsgi_ids()
+    for path in sorted(_owned_paths):
+        if os.path.lexists(path):
+            chown_if_needed(path, uid, gid)
+    _owned_paths.clear()
+
+
+#------------------------------------------------------------------------------
+# precompile:  Byte-compiles the python sources under root that are newer than
+#              their bytecode, so reloaded workers don't compile on import, and
+#              removes the .pyc files left behind by deleted sources.
+#------------------------------------------------------------------------------
+PRECOMPILE_SKIP_DIRS = ('.git', '.hg', '.bzr', '.svn')
+
+
+def precompile(root):
+    start = time.time()
+    compiled = removed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in PRECOMPILE_SKIP_DIRS]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith('.pyc'):
+                if not os.path.exists(path[:-1]):
+                    os.remove(path)
+                    removed += 1
+            elif name.endswith('.py'):
+                if os.path.exists(path + 'c') and \
+                   os.path.getmtime(path + 'c') >= os.path.getmtime(path):
+                    continue
+                try:
+                    py_compile.compile(path, doraise=True)
+                except py_compile.PyCompileError, e:
+                    juju_log(MSG_WARNING, "Not compiling %s: %s" % (path, e.msg))
+                    continue
+                own_path(path + 'c')
+                compiled += 1
+    juju_log(MSG_INFO, "Precompiled %d files and removed %d stale ones in %s "
+             "in %.2fs" % (compiled, removed, root, time.time() - start))
+    return compiled
+
+
+#------------------------------------------------------------------------------
+# schema_fingerprint:  Hashes the models and migrations of the project along
+#                      with the database they are synced to, the settings
+#                      that enable apps and the installed python packages,
+#                      which ship models of their own. Returns the
+#                      fingerprint and whether the project has migrations.
+#------------------------------------------------------------------------------
+SCHEMA_SKIP_DIRS = ('.git', '.hg', '.bzr', '.svn', '.venv')
+
+
+def schema_fingerprint(database_target):
+    digest = hashlib.sha1(database_target)
+    digest.update(file_hash(settings_py_path) or '')
+    for path in sorted(glob.glob(os.path.join(settings_dir_path, '*.py'))):
+        with open(path, 'r') as fragment:
+            if 'INSTALLED_APPS' in fragment.read():
+                digest.update(os.path.basename(path))
+                digest.update(file_hash(path))
+    try:
+        digest.update(json.dumps(sorted(pip_frozen().items())))
+    except (OSError, subprocess.CalledProcessError):
+        juju_log(MSG_WARNING, "pip freeze failed, python packages not fingerprinted")
+    has_migrations = False
+    for dirpath, dirnames, filenames in os.walk(working_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in SCHEMA_SKIP_DIRS)
+        parts = os.path.relpath(dirpath, working_dir).split(os.sep)
+        has_migrations = has_migrations or 'migrations' in parts
+        for name in sorted(filenames):
+            if name.endswith('.py') and (name == 'models.py' or
+               'models' in parts or 'migrations' in parts):
+                path = os.path.join(dirpath, name)
+                digest.update(os.path.relpath(path, working_dir))
+                digest.update(file_hash(path))
+    return digest.hexdigest(), has_migrations
+
+
+#------------------------------------------------------------------------------
+# Charm state:  Small key/value store persisted between hook runs
+#------------------------------------------------------------------------------
+def charm_state_path():
+    return os.path.join(os.environ['CHARM_DIR'], '.charm-state.json')
+
+
+def state_get(key, default=None):
+    if os.path.exists(charm_state_path()):
+        with open(charm_state_path(), 'r') as state_file:
+            return json.load(state_file).get(key, default)
+    return default
+
+
+_state_lock = threading.RLock()
+
+
+def state_set(keyvalues):
+    with _state_lock:
+        state = {}
+        if os.path.exists(charm_state_path()):
+            with open(charm_state_path(), 'r') as state_file:
+                state = json.load(state_file)
+        state.update(keyvalues)
+        # Replaced at once: a hook killed while writing must not break the next
+        with open(charm_state_path() + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(charm_state_path() + '.tmp', charm_state_path())
+
+
+#------------------------------------------------------------------------------
+# Reload coordinator:  Hooks call request_reload() when they touched the
+#                      generated settings. reload_flush() then bumps
+#                      wsgi_timestamp at most once per hook, only if the
+#                      settings and urls directories differ from the last
+#                      reload, and no more than once per reload_window
+#                      seconds. The hook waits for the end of the window
+#                      when it is at most RELOAD_WAIT_MAX seconds away,
+#                      otherwise the reload fires with the next hook that
+#                      runs after it, update-status at the latest.
+#------------------------------------------------------------------------------
+RELOAD_WAIT_MAX = 30
+
+_reload_request = {'dirty': False, 'force': False}
+
+
+def request_reload(force=False):
+    _reload_request['dirty'] = True
+    _reload_request['force'] = _reload_request['force'] or force
+
+
+def settings_fingerprint():
+    digest = hashlib.sha1()
+    for dir_path in (settings_dir_path, urls_dir_path):
+        if not os.path.isdir(dir_path):
+            continue
+        for name in sorted(os.listdir(dir_path)):
+            path = os.path.join(dir_path, name)
+            if os.path.isfile(path):
+                digest.update(path)
+                digest.update(file_hash(path))
+    return digest.hexdigest()
+
+
+def reload_flush():
+    pending = state_get('reload_pending', False)
+    if not (_reload_request['dirty'] or pending):
+        return
+
+    # The settings on disk may already be waiting for the leader, e.g. the
+    # engine of a database it hasn't migrated yet
+    waiting = [name for name in sorted(LEADER_TASKS)
+               if state_get(name + '_waiting')]
+    if waiting:
+        juju_log(MSG_INFO, "Waiting for the leader to run %s, deferring WSGI reload" %
+                 ', '.join(waiting))
+        state_set({'reload_pending': True})
+        return
+
+    fingerprint = settings_fingerprint()
+    if not (_reload_request['force'] or pending) and \
+       fingerprint == state_get('reload_fingerprint'):
+        juju_log(MSG_DEBUG, "Settings unchanged, skipping WSGI reload")
+        return
+
+    now = time.time()
+    remaining = state_get('reload_time', 0) + config_data['reload_window'] - now
+    if remaining > RELOAD_WAIT_MAX:
+        juju_log(MSG_INFO, "WSGI reloaded less than %ss ago, deferring" %
+                 config_data['reload_window'])
+        state_set({'reload_pending': True})
+        return
+    elif remaining > 0:
+        juju_log(MSG_INFO, "Waiting %.1fs for the reload window" % remaining)
+        time.sleep(remaining)
+        now = time.time()
+
+    for relid in relation_ids('wsgi'):
+        relation_set({'wsgi_timestamp': now}, relation_id=relid)
+    state_set({'reload_pending': False, 'reload_time': now,
+               'reload_fingerprint': fingerprint})
+    _reload_request.update(dirty=False, force=False)
+
+
+#------------------------------------------------------------------------------
+# Leadership:  The leader elected by Juju (is-leader), or without it the unit
+#              with the lowest number among the ones on the cluster peer
+#              relation, runs the one-time tasks (migrations, ...). It then
+#              publishes a <task>_token with leader-set and on the cluster
+#              relation. The other units hold their reload until the
+#              leader's token matches their own.
+#------------------------------------------------------------------------------
+_leadership = {'checked': False, 'leader': None}
+
+
+def juju_is_leader():
+    # None when Juju predates leadership (1.23)
+    if not _leadership['checked']:
+        try:
+            _leadership['leader'] = json.loads(subprocess.check_output(
+                ['is-leader', '--format=json']))
+        except (OSError, subprocess.CalledProcessError):
+            _leadership['leader'] = None
+        _leadership['checked'] = True
+    return _leadership['leader']
+
+
+def unit_number(unit):
+    return int(unit.split('/')[-1])
+
+
+def cluster_peers():
+    peers = []
+    for relid in relation_ids('cluster'):
+        peers.extend(relation_list(relid))
+    return peers
+
+
+def leader_unit():
+    return min([os.environ['JUJU_UNIT_NAME']] + cluster_peers(),
+               key=unit_number)
+
+
+def is_leader():
+    leader = juju_is_leader()
+    if leader is not None:
+        return leader
+    if relation_ids('cluster') and not cluster_peers():
+        # A new unit may run hooks before its peers joined: only the first
+        # unit of the service leads alone
+        return unit_number(os.environ['JUJU_UNIT_NAME']) == 0
+    return leader_unit() == os.environ['JUJU_UNIT_NAME']
+
+
+def leader_setting(key):
+    if juju_is_leader() is not None:
+        value = subprocess.check_output(['leader-get', '--format=json', key])
+        return json.loads(value or 'null')
+    leader = leader_unit()
+    for relid in relation_ids('cluster'):
+        if leader in relation_list(relid):
+            return relation_get(key, leader, relid)
+    return None
+
+
+def leader_publish(settings):
+    if juju_is_leader():
+        run("leader-set %s" % ' '.join(
+            ["{}='{}'".format(k, v or '') for k, v in settings.items()]))
+    # The cluster relation also wakes up the units of an older Juju
+    for relid in relation_ids('cluster'):
+        relation_set(settings, relation_id=relid)
+
+
+#------------------------------------------------------------------------------
+# leader_task:  Runs function on the leader, unless it already ran for this
+#               token. Returns True once the task is done for token, on this
+#               unit or on the leader; False if waiting for the leader.
+#------------------------------------------------------------------------------
+def leader_task(name, token, function):
+    if is_leader():
+        if state_get(name + '_token') != token:
+            juju_log(MSG_INFO, "Running %s as the leader" % name)
+            function()
+            state_set({name + '_token': token})
+        leader_publish({name + '_token': token})
+    elif leader_setting(name + '_token') != token:
+        juju_log(MSG_INFO, "Waiting for the leader to run %s" % name)
+        state_set({name + '_waiting': token})
+        return False
+    state_set({name + '_waiting': None})
+    return True
+
+
+#------------------------------------------------------------------------------
+# site_secret_key:  Returns the SECRET_KEY of the site. site_secret_key from
+#                   the config wins. Otherwise the leader generates a key once
+#                   (or adopts the one already rendered), keeps it in the
+#                   charm state and shares it as secret_key on the cluster
+#                   relation. None while a new unit waits for the leader.
+#------------------------------------------------------------------------------
+SECRET_KEY_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*(-_=+)'
+
+
+def rendered_secret_key():
+    if os.path.exists(settings_secret_path):
+        with open(settings_secret_path, 'r') as secret_file:
+            match = re.search(r"^SECRET_KEY = '(.+)'$", secret_file.read(), re.M)
+            if match:
+                return match.group(1)
+    return None
+
+
+def site_secret_key():
+    if config_data['site_secret_key']:
+        return config_data['site_secret_key']
+
+    secret_key = state_get('secret_key')
+    if is_leader():
+        if not secret_key:
+            secret_key = rendered_secret_key() or \
+                ''.join([choice(SECRET_KEY_CHARS) for i in range(50)])
+            state_set({'secret_key': secret_key})
+        leader_publish({'secret_key': secret_key})
+    elif leader_setting('secret_key'):
+        # Kept in case this unit becomes the leader
+        secret_key = leader_setting('secret_key')
+        state_set({'secret_key': secret_key})
+    elif not secret_key:
+        # Serving with a key of its own would void the sessions of the others
+        juju_log(MSG_INFO, "Waiting for the leader to share the secret key")
+    return secret_key
+
+
+def write_secret_settings():
+    secret_key = site_secret_key()
+    if secret_key is None:
+        return False
+    return process_template('secret.tmpl', {'site_secret_key': secret_key},
+                            settings_secret_path)
+
+
+#------------------------------------------------------------------------------
+# migrate_database:  Syncs (and migrates) the database of the pgsql relation
+#                    on the leader when the schema fingerprint changed
+#------------------------------------------------------------------------------
+PGSQL_MASTER_STATES = ('standalone', 'master')
+PGSQL_STANDBY_STATES = ('hot standby',)
+
+
+def pgsql_unit_data():
+    # The master, or the unit of a postgresql charm that publishes no state
+    units = [u for u in relation_get_all('pgsql') if u.get('database')]
+    for unit_data in units:
+        if unit_data.get('state') in PGSQL_MASTER_STATES:
+            return unit_data
+    for unit_data in units:
+        if not unit_data.get('state'):
+            return unit_data
+    return None
+
+def pgsql_standbys():
+    return sorted((u for u in relation_get_all('pgsql') if u.get('database')
+                   and u.get('state') in PGSQL_STANDBY_STATES),
+                  key=lambda u: unit_number(u['unit']))
+
+def database_target():
+    unit_data = pgsql_unit_data()
+    if unit_data is None:
+        return None
+    return '%(user)s@%(host)s/%(database)s' % unit_data
+
+
+def migrate_database():
+    target = database_target()
+    if target is None:
+        return True
+    fingerprint, has_migrations = schema_fingerprint(target)
+
+    def syncdb():
+        django_admin_cmd = find_django_admin_cmd()
+        run("%s syncdb --noinput --pythonpath=%s --settings=%s" % \
+                (django_admin_cmd, install_root, django_settings_modules))
+        if has_migrations:
+            run("%s migrate --noinput --pythonpath=%s --settings=%s" % \
+                    (django_admin_cmd, install_root, django_settings_modules))
+
+    return leader_task('migrations', fingerprint, syncdb)
+
+
+#------------------------------------------------------------------------------
+# git_mirror:  Creates or fetches the bare mirror of repos_url kept under
+#              install_root and returns a url to clone or fetch from it
+#------------------------------------------------------------------------------
+def git_mirror():
+    if os.path.isdir(git_mirror_dir):
+        run('git remote update --prune', cwd=git_mirror_dir)
+    else:
+        run('git clone --mirror %s %s' % (repos_url, git_mirror_dir))
+    return 'file://' + git_mirror_dir
+
+
+#------------------------------------------------------------------------------
+# vcs_checkout:  Checks out repos_url into destination. Git clones only fetch
+#                the last commit of repos_branch when vcs_shallow is set and
+#                go through the local mirror when vcs_mirror is set.
+#------------------------------------------------------------------------------
+def vcs_checkout(destination):
     if vcs == 'hg' or vcs == 'mercurial':
-        run('hg clone %s %s' % (repos_url, vcs_clone_dir))
+        run('hg clone %s %s' % (repos_url, destination))
     elif vcs == 'git' or vcs == 'git-core':
+        cmd = 'git clone'
+        if vcs_shallow:
+            cmd += ' --depth 1 --single-branch'
         if repos_branch:
-            run('git clone %s -b %s %s' % (repos_url, repos_branch, vcs_clone_dir))
+            cmd += ' -b %s' % repos_branch
+        if vcs_mirror:
+            run('%s %s %s' % (cmd, git_mirror(), destination))
+            run('git remote set-url origin %s' % repos_url, cwd=destination)
         else:
-            run('git clone %s %s' % (repos_url, vcs_clone_dir))
+            run('%s %s %s' % (cmd, repos_url, destination))
     elif vcs == 'bzr' or vcs == 'bazaar':
-        run('bzr branch %s %s' % (repos_url, vcs_clone_dir))
+        run('bzr branch %s %s' % (repos_url, destination))
     elif vcs == 'svn' or vcs == 'subversion':
-        run('svn co %s %s' % (repos_url, vcs_clone_dir))
-    elif vcs == '' and repos_url == '':
-        juju_log(MSG_INFO, "No version control using django-admin startproject")
-        cmd = '%s startproject' % django_admin_cmd
-        if project_template_url:
-            cmd = " ".join([cmd, '--template', project_template_url])
-        if project_template_extension:
-            cmd = " ".join([cmd, '--extension', project_template_extension])
-        try:
-            run('%s %s %s' % (cmd, sanitized_unit_name, install_root), exit_on_error=False)
-        except subprocess.CalledProcessError:
-            run('%s %s' % (cmd, sanitized_unit_name), cwd=install_root)
+        run('svn co %s %s' % (repos_url, destination))
+    else:
+        juju_log(MSG_ERROR, "Unknown version control")
+        sys.exit(1)
+
 
+#------------------------------------------------------------------------------
+# vcs_update:  Brings the checkout in directory up to date with repos_url.
+#              Git only fetches repos_branch (the last commit of it when
+#              vcs_shallow is set) and resets the checkout to it.
+#------------------------------------------------------------------------------
+def vcs_update(directory):
+    if vcs == 'hg' or vcs == 'mercurial':
+        run('hg pull -u %s' % repos_url, cwd=directory)
+    elif vcs == 'git' or vcs == 'git-core':
+        cmd = 'git fetch'
+        if vcs_shallow:
+            cmd += ' --depth 1'
+        source = git_mirror() if vcs_mirror else repos_url
+        run('%s %s %s' % (cmd, source, repos_branch or 'HEAD'), cwd=directory)
+        run('git reset --hard FETCH_HEAD', cwd=directory)
+    elif vcs == 'bzr' or vcs == 'bazaar':
+        run('bzr pull %s' % repos_url, cwd=directory)
+    elif vcs == 'svn' or vcs == 'subversion':
+        run('svn up', cwd=directory)
     else:
         juju_log(MSG_ERROR, "Unknown version control")
         sys.exit(1)
 
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
 
-    install_dir(settings_dir_path, owner=wsgi_user, group=wsgi_group, mode=0755)
-    install_dir(urls_dir_path, owner=wsgi_user, group=wsgi_group, mode=0755)
+#------------------------------------------------------------------------------
+# vcs_revision:  Returns the revision checked out in directory, the same on
+#                every unit deploying it, or None without a vcs checkout.
+#------------------------------------------------------------------------------
+VCS_REVISION_COMMANDS = {
+    'git': 'git rev-parse HEAD', 'git-core': 'git rev-parse HEAD',
+    'hg': 'hg id -i', 'mercurial': 'hg id -i',
+    'bzr': 'bzr revno', 'bazaar': 'bzr revno',
+    'svn': 'svnversion', 'subversion': 'svnversion',
+}
+
+
+def vcs_revision(directory):
+    if vcs not in VCS_REVISION_COMMANDS or not os.path.isdir(directory):
+        return None
+    try:
+        return run(VCS_REVISION_COMMANDS[vcs], exit_on_error=False,
+                   cwd=directory).strip() or None
+    except subprocess.CalledProcessError:
+        return None
+
+
+#------------------------------------------------------------------------------
+# run_phases:  Runs the {name: (function, [dependencies])} phases of a hook on
+#              worker threads, each one as soon as its dependencies are done,
+#              so independent phases overlap. Once a phase fails no other one
+#              is started and its exception is raised again when the running
+#              ones are over.
+#------------------------------------------------------------------------------
+PHASE_WORKERS = 4
+
+
+def run_phases(phases, workers=PHASE_WORKERS):
+    pending = dict(phases)
+    done = set()
+    running = set()
+    failures = []
+    finished = threading.Condition()
+
+    def run_phase(name, function):
+        try:
+            function()
+        except BaseException, e:
+            juju_log(MSG_ERROR, "Phase %s failed: %r" % (name, e))
+            failures.append(e)
+        with finished:
+            running.discard(name)
+            done.add(name)
+            finished.notify()
+
+    with finished:
+        while running or (pending and not failures):
+            ready = sorted(name for name, (function, deps) in pending.items()
+                           if done.issuperset(deps))
+            if not failures:
+                for name in ready[:workers - len(running)]:
+                    function = pending.pop(name)[0]
+                    juju_log(MSG_DEBUG, "Starting phase %s" % name)
+                    running.add(name)
+                    threading.Thread(target=run_phase,
+                                     args=(name, function)).start()
+            if not running:
+                juju_log(MSG_ERROR, "Unresolvable phases: %s" %
+                         ', '.join(sorted(pending)))
+                sys.exit(1)
+            finished.wait()
+    if failures:
+        raise failures[0]
+
+
+#------------------------------------------------------------------------------
+# Releases:  With keep_releases set, every install and upgrade checks the code
+#            out into a new directory of releases_dir, installs its python
+#            requirements in a virtualenv of its own and byte-compiles it.
+#            Only then the "current" symlink is switched to it, atomically.
+#            vcs_clone_dir is a symlink to "current" and the generated
+#            settings and urls directories live in releases_dir/shared.
+#------------------------------------------------------------------------------
+def checkout_release():
+    release = time.strftime('%Y%m%d%H%M%S')
+    # Never check out into a release of the same second, maybe the current one
+    while os.path.exists(os.path.join(releases_dir, release)):
+        release = str(int(release) + 1)
+    release_dir = os.path.join(releases_dir, release)
+    juju_log(MSG_INFO, "Checking out release %s" % release_dir)
+    if not os.path.isdir(releases_dir):
+        install_dir(releases_dir, owner=wsgi_user, group=wsgi_group, mode=0755)
+    vcs_checkout(release_dir)
+    return release_dir
+
+
+def build_release(release_dir):
+    global pip_executable
+
+    if application_path:
+        release_working_dir = os.path.join(release_dir, application_path)
+    else:
+        release_working_dir = release_dir
+    juju_log(MSG_INFO, "Building release %s" % release_dir)
+
+    # Generated settings and urls are shared by every release
+    for name in (config_data["settings_dir_name"], config_data["urls_dir_name"]):
+        shared_path = os.path.join(shared_dir, name)
+        legacy_path = os.path.join(working_dir, name)
+        if not os.path.isdir(shared_path):
+            if os.path.isdir(legacy_path) and not os.path.islink(vcs_clone_dir):
+                shutil.copytree(legacy_path, shared_path)
+            else:
+                install_dir(shared_path, owner=wsgi_user, group=wsgi_group,
+                            mode=0755)
+        if not os.path.lexists(os.path.join(release_working_dir, name)):
+            os.symlink(shared_path, os.path.join(release_working_dir, name))
+
+    # So are the files the project writes, like the uploads
+    for name in shared_dirs:
+        shared_path = os.path.join(shared_dir, name)
+        legacy_path = os.path.join(working_dir, name)
+        release_path = os.path.join(release_working_dir, name)
+        if not os.path.isdir(shared_path):
+            if os.path.isdir(legacy_path) and not os.path.islink(vcs_clone_dir):
+                shutil.copytree(legacy_path, shared_path, symlinks=True)
+            elif os.path.isdir(release_path) and not os.path.islink(release_path):
+                shutil.copytree(release_path, shared_path, symlinks=True)
+            else:
+                install_dir(shared_path, owner=wsgi_user, group=wsgi_group,
+                            mode=0755)
+        if os.path.isdir(release_path) and not os.path.islink(release_path):
+            shutil.rmtree(release_path)
+        if not os.path.lexists(release_path):
+            if not os.path.isdir(os.path.dirname(release_path)):
+                os.makedirs(os.path.dirname(release_path))
+            os.symlink(shared_path, release_path)
+
+    for path, dir in (('settings.py', 'juju_settings'), ('urls.py', 'juju_urls')):
+        append_template('conf_injection.tmpl', {'dir': dir},
+                        os.path.join(release_working_dir, path))
+
+    write_wsgi_py(release_working_dir)
+
+    venv_dir = os.path.join(release_dir, '.venv')
+    run('virtualenv --system-site-packages %s' % venv_dir)
+    pip_executable = os.path.join(venv_dir, 'bin', 'pip')
+    extra_packages = extra_pip_pkgs.split(',') if extra_pip_pkgs else []
+    if pip_wheelhouse:
+        pip_install_wheelhouse(pip_wheelhouse,
+                               requirements_pip_paths(release_working_dir),
+                               extra_packages)
+    else:
+        for package in extra_packages:
+            pip_install(package)
+        for req_path in requirements_pip_paths(release_working_dir):
+            if os.path.exists(req_path):
+                pip_install_req(req_path)
+    pip_executable = 'pip'
+
+    precompile(release_dir)
+    chown_tree(release_dir)
+
+
+def activate_release(release_dir):
+    tmp_link = current_release_link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(release_dir, tmp_link)
+    os.rename(tmp_link, current_release_link)
+
+    if not os.path.islink(vcs_clone_dir):
+        if os.path.exists(vcs_clone_dir):
+            juju_log(MSG_WARNING, "Moving the in-place checkout %s to %s.orig" %
+                     (vcs_clone_dir, vcs_clone_dir))
+            os.rename(vcs_clone_dir, vcs_clone_dir + '.orig')
+        os.symlink(current_release_link, vcs_clone_dir)
+    juju_log(MSG_INFO, "Release %s is now current" % release_dir)
+
+
+def prune_releases():
+    current = os.path.realpath(current_release_link)
+    releases = sorted(name for name in os.listdir(releases_dir)
+                      if name.isdigit())
+    for name in releases[:-keep_releases]:
+        path = os.path.join(releases_dir, name)
+        if os.path.realpath(path) != current:
+            juju_log(MSG_INFO, "Removing old release %s" % path)
+            shutil.rmtree(path)
+
+
+#------------------------------------------------------------------------------
+# write_wsgi_py:  Renders the WSGI module of the project unless the project
+#                 ships its own. Returns True when the file changed.
+#------------------------------------------------------------------------------
+WSGI_PY_MARKER = "# This file is managed by Juju"
+
+
+def write_wsgi_py(project_dir):
+    wsgi_py_path = os.path.join(project_dir, 'wsgi.py')
+    if os.path.exists(wsgi_py_path):
+        with open(wsgi_py_path, 'r') as wsgi_py:
+            if WSGI_PY_MARKER not in wsgi_py.read():
+                return False
+
+    split = lambda value: [str(v.strip()) for v in value.split(',') if v.strip()]
+    return process_template('wsgi.py.tmpl', {
+        'project_name': sanitized_unit_name,
+        'django_settings': django_settings,
+        'warmup': config_data['warmup'],
+        'warmup_templates': split(config_data['warmup_templates']),
+        'warmup_urls': split(config_data['warmup_urls']),
+    }, wsgi_py_path)
+
+
+#------------------------------------------------------------------------------
+# write_database_settings:  Renders the settings of the database published on
+#                           the pgsql relation: the master as default and a
+#                           replica_<unit number> alias per hot standby, with
+#                           a router sending reads to them when
+#                           database_read_replicas is set. Connects through a
+#                           local pgbouncer when database_pooler is set.
+#                           Returns True when the settings changed.
+#------------------------------------------------------------------------------
+PGBOUNCER_PORT = 6432
+
+
+def configure_pgbouncer(templ_vars):
+    apt_get_install(['pgbouncer'])
+    ini = render_template('pgbouncer.ini.tmpl', dict(
+        templ_vars, pooler_port=PGBOUNCER_PORT,
+        pool_size=config_data['database_pooler_size']))
+    userlist = '"%(db_user)s" "%(db_password)s"\n' % templ_vars
+
+    changed = False
+    for contents, path in ((ini, '/etc/pgbouncer/pgbouncer.ini'),
+                           (userlist, '/etc/pgbouncer/userlist.txt')):
+        if file_hash(path) != content_hash(contents):
+            install_file(contents, path, owner='postgres', group='postgres',
+                         mode=0640)
+            changed = True
+
+    if os.path.exists('/etc/default/pgbouncer'):
+        run("sed -i 's/^START=0/START=1/' /etc/default/pgbouncer")
+    if changed:
+        run('service pgbouncer reload || service pgbouncer start')
+
+
+def write_database_settings():
+    unit_data = pgsql_unit_data()
+    if unit_data is None:
+        return False
+
+    conn_max_age = config_data['database_conn_max_age']
+    templ_vars = {
+       'db_engine': 'django.db.backends.postgresql_psycopg2',
+       'db_database': unit_data['database'],
+       'db_user': unit_data.get('user'),
+       'db_password': unit_data.get('password'),
+       # A negative age keeps the connections open for good
+       'db_conn_max_age': conn_max_age if conn_max_age >= 0 else None,
+       'db_connect_timeout': config_data['database_connect_timeout'],
+       'db_statement_timeout': config_data['database_statement_timeout'],
+       'db_pooler': config_data['database_pooler'],
+    }
+    primary = {'name': unit_data['database'], 'host': unit_data.get('host'),
+               'port': unit_data.get('port', ''), 'replica': False}
+    replicas = []
+    for standby in pgsql_standbys():
+        replicas.append({
+            'alias': 'replica_%d' % unit_number(standby['unit']),
+            'name': standby['database'],
+            'host': standby.get('host'),
+            'port': standby.get('port', ''),
+            'replica': True,
+            # The router checks the standby itself, even behind pgbouncer
+            'check_host': standby.get('host'),
+            'check_port': int(standby.get('port') or 5432),
+        })
+    templ_vars.update({
+        'db_primary': primary,
+        'db_replicas': replicas,
+        'db_router': bool(replicas) and config_data['database_read_replicas'],
+    })
+
+    if templ_vars['db_pooler']:
+        for replica in replicas:
+            replica['name'] = '%s_%s' % (unit_data['database'], replica['alias'])
+        templ_vars['db_pooled'] = [dict(db) for db in [primary] + replicas]
+        configure_pgbouncer(templ_vars)
+        for db in [primary] + replicas:
+            db.update({'host': '127.0.0.1', 'port': PGBOUNCER_PORT})
+
+    return process_template('engine.tmpl', templ_vars,
+                            settings_database_path % {'engine_name': 'pgsql'})
+
+
+#------------------------------------------------------------------------------
+# write_cache_settings:  Renders the cache settings from every memcached unit
+#                        of the cache relations, in a stable order, with the
+#                        juju_cache backends placing the keys on a hash ring,
+#                        behind an LRU of the process when cache_local_size
+#                        is set. Returns True when the settings changed.
+#------------------------------------------------------------------------------
+def cache_locations():
+    locations = set()
+    for unit_data in relation_get_all('cache'):
+        if unit_data.get('host'):
+            locations.add('%s:%s' % (unit_data['host'],
+                                     unit_data.get('port') or 11211))
+    return sorted(locations)
+
+
+def write_cache_settings():
+    cache_path = settings_database_path % {'engine_name': 'memcache'}
+    locations = cache_locations()
+    if not locations:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+            return True
+        return False
+
+    packages = ["python-memcache"]
+    if config_data['cache_binary_protocol']:
+        packages.append("python-pylibmc")
+    apt_get_install(packages)
+
+    # The backends are importable from the python path of the project
+    module_path = os.path.join(install_root, 'juju_cache.py')
+    module_changed = process_template('juju_cache.py.tmpl', {}, module_path)
+    if module_changed:
+        py_compile.compile(module_path)
+
+    if config_data['cache_binary_protocol']:
+        cache_engine = 'PyLibMCCache'
+    else:
+        cache_engine = 'MemcachedCache'
+    if config_data['cache_local_size'] > 0:
+        cache_engine = 'TwoLevel' + cache_engine
+    return process_template('cache.tmpl', {
+        'cache_engine': 'juju_cache.' + cache_engine,
+        'cache_locations': locations,
+        'cache_local_size': config_data['cache_local_size'] * 1024,
+        'cache_local_timeout': config_data['cache_local_timeout'],
+    }, cache_path) or module_changed
+
+
+#------------------------------------------------------------------------------
+# write_performance_settings:  Renders the performance_profile fragment:
+#                              cached template loader, conditional GET and
+#                              gzip middleware, and sessions in the cache
+#                              when a cache relation exists. Returns True when
+#                              the settings changed.
+#------------------------------------------------------------------------------
+PERFORMANCE_PROFILES = ('none', 'balanced', 'aggressive')
+
 
-    #FIXME: Upgrades/pulls will mess those files
+def write_performance_settings():
+    profile = config_data['performance_profile']
+    if profile not in PERFORMANCE_PROFILES:
+        juju_log(MSG_ERROR, "Unknown performance_profile %s, expected one of %s"
+                 % (profile, ', '.join(PERFORMANCE_PROFILES)))
+        return False
+    if profile == 'none':
+        if os.path.exists(settings_performance_path):
+            os.remove(settings_performance_path)
+            return True
+        return False
 
-    for path, dir in ((settings_py_path, 'juju_settings'), (urls_py_path, 'juju_urls')):
-        append_template('conf_injection.tmpl', {'dir': dir}, path)
+    # The charm's database is shared by the units, a project's sqlite file
+    # isn't: without pgsql the sessions only live in the shared cache
+    session_engine = None
+    if cache_locations():
+        if profile == 'balanced' and pgsql_unit_data() is not None:
+            session_engine = 'django.contrib.sessions.backends.cached_db'
+        else:
+            session_engine = 'django.contrib.sessions.backends.cache'
 
-    if requirements_pip_files:
-       for req_file in requirements_pip_files.split(','):
-            pip_install_req(os.path.join(working_dir,req_file))
+    return process_template('performance.tmpl', {
+        'profile': profile,
+        'session_engine': session_engine,
+    }, settings_performance_path)
 
-    wsgi_py_path = os.path.join(working_dir, 'wsgi.py')
-    if not os.path.exists(wsgi_py_path):
-        process_template('wsgi.py.tmpl', {'project_name': sanitized_unit_name, \
-                                          'django_settings': django_settings}, \
-                                          wsgi_py_path)
+
+#------------------------------------------------------------------------------
+# write_page_cache_settings:  Renders the page_cache_rules fragment and the
+#                             juju_page_cache middleware caching the matching
+#                             pages, under a key prefix that changes with
+#                             the deployed code and is shared by every unit.
+#                             Returns True when the settings changed.
+#------------------------------------------------------------------------------
+def code_release():
+    # The vcs revision, else the time of the last install or upgrade
+    return vcs_revision(vcs_clone_dir) or state_get('code_release', '')
+
+
+def page_cache_rules():
+    rules = []
+    for rule in config_data['page_cache_rules'].split():
+        pattern, _, ttl = rule.rpartition('=')
+        if not pattern or not ttl.isdigit():
+            juju_log(MSG_ERROR, "Ignoring the page_cache_rules entry %s, "
+                     "expected <url regex>=<seconds>" % rule)
+            continue
+        rules.append((str(pattern), int(ttl)))
+    return rules
+
+
+def write_page_cache_settings():
+    rules = page_cache_rules()
+    if not rules:
+        if os.path.exists(settings_page_cache_path):
+            os.remove(settings_page_cache_path)
+            return True
+        return False
+
+    # The middleware is importable from the python path of the project
+    module_path = os.path.join(install_root, 'juju_page_cache.py')
+    module_changed = process_template('juju_page_cache.py.tmpl', {}, module_path)
+    if module_changed:
+        py_compile.compile(module_path)
+
+    vary = [str(h.strip()) for h in config_data['page_cache_vary'].split(',')
+            if h.strip()]
+    return process_template('page_cache.tmpl', {
+        'page_cache_rules': repr(rules),
+        'page_cache_vary': repr(vary),
+        'page_cache_prefix': code_release(),
+        'page_cache_grace': config_data['page_cache_grace'],
+    }, settings_page_cache_path) or module_changed
+
+
+#------------------------------------------------------------------------------
+# collect_static:  Renders the static files settings, then runs collectstatic
+#                  for each new code release into its own directory under
+#                  static_dir, seeded with hard links to the previous one so
+#                  the pages already served find their hashed files. Gzips
+#                  the text assets next to them and switches the
+#                  static_dir/current link to it. Returns True when it did.
+#------------------------------------------------------------------------------
+STATIC_GZIP_EXTENSIONS = ('.css', '.js', '.json', '.map', '.svg', '.txt',
+                          '.html', '.xml', '.ico', '.eot', '.ttf')
+STATIC_GZIP_MIN_SIZE = 256
+STATIC_KEEP = 3
+
+
+def static_collected():
+    # Hashed names are looked up in a manifest that only a collect writes
+    return bool(state_get('static_release')) and \
+        os.path.isdir(static_current_link)
+
+
+def write_static_settings():
+    if not config_data['static_collect']:
+        if os.path.exists(settings_static_path):
+            os.remove(settings_static_path)
+            return True
+        return False
+    return process_template('static.tmpl', {
+        'static_url': config_data['static_url'],
+        'static_root': static_current_link,
+        'collected': static_collected(),
+    }, settings_static_path)
+
+
+def gzip_static(root):
+    compressed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.lower().endswith(STATIC_GZIP_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            mtime = os.path.getmtime(path)
+            if os.path.getsize(path) < STATIC_GZIP_MIN_SIZE or \
+               (os.path.exists(path + '.gz') and
+                    os.path.getmtime(path + '.gz') >= mtime):
+                continue
+            # Written aside: the old .gz may be a link into another release
+            with open(path, 'rb') as source:
+                with open(path + '.gz.tmp', 'wb') as target:
+                    gz = gzip.GzipFile(name, 'wb', 9, target, int(mtime))
+                    shutil.copyfileobj(source, gz)
+                    gz.close()
+            os.rename(path + '.gz.tmp', path + '.gz')
+            compressed += 1
+    return compressed
+
+
+def collect_static():
+    release = code_release() or 'initial'
+    if not config_data['static_collect'] or not os.path.isdir(working_dir) or \
+       state_get('static_release') == release:
+        return False
+    # A failed release is retried with new code or a new config only
+    attempt = hashlib.sha1(release + json.dumps(config_data, sort_keys=True))
+    if state_get('static_failed') == attempt.hexdigest():
+        return False
+
+    version_dir = os.path.join(static_dir, release)
+    if os.path.isdir(version_dir):
+        shutil.rmtree(version_dir)
+    if os.path.isdir(static_current_link):
+        run('cp -al %s %s' % (os.path.realpath(static_current_link), version_dir))
+    else:
+        install_dir(version_dir, owner=wsgi_user, group=wsgi_group, mode=0755)
+
+    start = time.time()
+    os.environ['JUJU_STATIC_ROOT'] = version_dir
+    try:
+        run("%s collectstatic --noinput --pythonpath=%s --settings=%s" % \
+                (find_django_admin_cmd(), install_root, django_settings_modules),
+            exit_on_error=False)
+    except subprocess.CalledProcessError:
+        juju_log(MSG_ERROR, "collectstatic failed, keeping the current static files")
+        shutil.rmtree(version_dir)
+        state_set({'static_failed': attempt.hexdigest()})
+        return False
+    finally:
+        del os.environ['JUJU_STATIC_ROOT']
+    compressed = gzip_static(version_dir)
+    chown_tree(version_dir)
+
+    tmp_link = static_current_link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version_dir, tmp_link)
+    os.rename(tmp_link, static_current_link)
+    state_set({'static_release': release})
+    juju_log(MSG_INFO, "Collected the static files of %s, %d gzipped, in %.2fs"
+             % (release, compressed, time.time() - start))
+
+    versions = sorted((os.path.join(static_dir, name)
+                       for name in os.listdir(static_dir) if name != 'current'),
+                      key=os.path.getctime)
+    for path in versions[:-STATIC_KEEP]:
+        if os.path.isdir(path) and path != version_dir:
+            shutil.rmtree(path)
+    return True
+
+
+###############################################################################
+# Hook functions
+###############################################################################
+def install():
+    release = {}
+
+    def install_charm_packages():
+        apt_get_install(CHARM_PACKAGES)
+
+    def install_django():
+        configure_and_install(django_version)
+
+    def install_distro_packages():
+        if extra_deb_pkgs:
+            apt_get_install(extra_deb_pkgs.split(','))
+
+    def install_pip_packages():
+        if extra_pip_pkgs and not pip_wheelhouse and not release_mode:
+            if not [package for package in extra_pip_pkgs.split(',')
+                    if pip_install(package)]:
+                pip_requirements_record(packages=extra_pip_pkgs)
+
+    def checkout():
+        if repos_username:
+            m = re.match(".*://([^/]+)/.*", repos_url)
+            if m is not None:
+                repos_domain = m.group(1)
+                template_vars = {
+                    'repos_domain': repos_domain,
+                    'repos_username': repos_username,
+                    'repos_password': repos_password
+                }
+                from os.path import expanduser
+                process_template('netrc.tmpl', template_vars, expanduser('~/.netrc'))
+            else:
+                juju_log(MSG_ERROR, '''Failed to process repos_username and repos_password:\n
+                                       cannot identify domain in URL {0}'''.format(repos_url))
+
+        if release_mode:
+            release['dir'] = checkout_release()
+        elif vcs == '' and repos_url == '':
+            juju_log(MSG_INFO, "No version control using django-admin startproject")
+            cmd = '%s startproject' % find_django_admin_cmd()
+            if project_template_url:
+                cmd = " ".join([cmd, '--template', project_template_url])
+            if project_template_extension:
+                cmd = " ".join([cmd, '--extension', project_template_extension])
+            try:
+                run('%s %s %s' % (cmd, sanitized_unit_name, install_root), exit_on_error=False)
+            except subprocess.CalledProcessError:
+                run('%s %s' % (cmd, sanitized_unit_name), cwd=install_root)
+        else:
+            vcs_checkout(vcs_clone_dir)
+
+    def setup_project():
+        if release_mode:
+            build_release(release['dir'])
+            activate_release(release['dir'])
+            prune_releases()
+            return
+
+        chown_tree(working_dir)
+
+        install_dir(settings_dir_path, owner=wsgi_user, group=wsgi_group, mode=0755)
+        install_dir(urls_dir_path, owner=wsgi_user, group=wsgi_group, mode=0755)
+
+        for path, dir in ((settings_py_path, 'juju_settings'), (urls_py_path, 'juju_urls')):
+            append_template('conf_injection.tmpl', {'dir': dir}, path)
+
+        if pip_wheelhouse:
+            if not pip_install_wheelhouse(pip_wheelhouse, requirements_pip_paths(),
+                                          extra_pip_pkgs.split(',') if extra_pip_pkgs else []):
+                pip_requirements_record(requirements_pip_paths(), extra_pip_pkgs)
+        elif requirements_pip_files:
+           for req_file in requirements_pip_files.split(','):
+                req_path = os.path.join(working_dir, req_file)
+                if not pip_install_req(req_path):
+                    pip_requirements_record([req_path])
+
+        write_wsgi_py(working_dir)
+
+        precompile(working_dir)
+
+    # The checkout only waits for the vcs tools, except startproject which
+    # needs django-admin
+    checkout_deps = ['charm_packages']
+    if vcs == '' and repos_url == '':
+        checkout_deps.append('django')
+
+    run_phases({
+        'charm_packages': (install_charm_packages, []),
+        'django': (install_django, ['charm_packages']),
+        'distro_packages': (install_distro_packages, ['charm_packages']),
+        # Packages built from source need the distro headers
+        'pip_packages': (install_pip_packages, ['django', 'distro_packages']),
+        'checkout': (checkout, checkout_deps),
+        'project': (setup_project, ['checkout', 'django', 'distro_packages',
+                                    'pip_packages']),
+    })
+
+    # Keys derived from the code, like the page cache's, change with it
+    state_set({'code_release': str(int(time.time()))})
 
 def start():
     if os.path.exists(os.path.join('/etc/init/', sanitized_unit_name + '.conf')):
@@ -545,57 +1939,108 @@ def config_changed(config_data):
     os.environ['DJANGO_SETTINGS_MODULE'] = django_settings_modules
     django_admin_cmd = find_django_admin_cmd()
 
-    site_secret_key = config_data['site_secret_key']
-    if not site_secret_key:
-        site_secret_key = ''.join([choice('abcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*(-_=+)') for i in range(50)])
+    if write_secret_settings():
+        # Trigger WSGI reloading
+        request_reload()
 
-    process_template('secret.tmpl', {'site_secret_key': site_secret_key}, settings_secret_path)
+    # The connection options of the database are rendered from the config
+    if write_database_settings():
+        request_reload()
 
-    # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    if write_cache_settings():
+        request_reload()
 
-def upgrade():
-    if extra_pip_pkgs:
-        for package in extra_pip_pkgs.split(','):
-            pip_install(package, upgrade=True)
-
-    apt_get_update()
-    for retry in xrange(0,24):
-        if apt_get_install(CHARM_PACKAGES):
-            time.sleep(10)
-        else:
-            break
+    if write_performance_settings():
+        request_reload()
 
-    if vcs == 'hg' or vcs == 'mercurial':
-        run('hg pull %s %s' % (repos_url, vcs_clone_dir))
-    elif vcs == 'git' or vcs == 'git-core':
-        if repos_branch:
-            run('git pull %s -b %s %s' % (repos_url, repos_branch, vcs_clone_dir))
-        else:
-            run('git pull %s %s' % (repos_url, vcs_clone_dir))
-    elif vcs == 'bzr' or vcs == 'bazaar':
-        run('bzr pull %s %s' % (repos_url, vcs_clone_dir))
-    elif vcs == 'svn' or vcs == 'subversion':
-        run('svn up %s %s' % (repos_url, vcs_clone_dir))
-    else:
-        juju_log(MSG_ERROR, "Unknown version control")
-        sys.exit(1)
+    if write_page_cache_settings():
+        request_reload()
 
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
+    # The static files follow the code, the front proxy serves them
+    if write_static_settings():
+        request_reload()
+    if collect_static():
+        write_static_settings()
+        request_reload()
+    for relid in relation_ids('website'):
+        relation_set(website_relation_settings(), relation_id=relid)
 
-    if requirements_pip_files:
-       for req_file in requirements_pip_files.split(','):
-            pip_install_req(os.path.join(working_dir,req_file), upgrade=True)
+    # The warm-up options are rendered in the WSGI module and change the
+    # settings published to Gunicorn
+    if os.path.isdir(working_dir) and write_wsgi_py(working_dir):
+        for relid in relation_ids('wsgi'):
+            relation_set(wsgi_relation_settings(), relation_id=relid)
+        # The settings fingerprint doesn't cover wsgi.py
+        request_reload(force=True)
 
+def upgrade():
+    release = {}
+    extra_pip_delta = []
+    if not release_mode and pip_packages_changed(extra_pip_pkgs):
+        extra_pip_delta = pip_missing(
+            extra_pip_pkgs.split(',') if extra_pip_pkgs else [])
+
+    def upgrade_charm_packages():
+        apt_get_update()
+        apt_get_install(CHARM_PACKAGES, upgrade=True)
+
+    def upgrade_pip_packages():
+        if not pip_wheelhouse and not release_mode:
+            if not [package for package in extra_pip_delta
+                    if pip_install(package, upgrade=True)]:
+                pip_requirements_record(packages=extra_pip_pkgs)
+
+    def update_code():
+        if release_mode:
+            release['dir'] = checkout_release()
+            return
+
+        vcs_update(vcs_clone_dir)
+
+        # The update may have dropped the injected import code
+        for path, dir in ((settings_py_path, 'juju_settings'), (urls_py_path, 'juju_urls')):
+            append_template('conf_injection.tmpl', {'dir': dir}, path)
+
+        chown_tree(working_dir)
+
+    def upgrade_requirements():
+        if release_mode:
+            build_release(release['dir'])
+            activate_release(release['dir'])
+            prune_releases()
+            return
+
+        # Only the requirement files that changed since the last pip run.
+        # Without --upgrade pip only installs the requirements the installed
+        # packages don't satisfy instead of upgrading every line and its
+        # dependencies.
+        req_paths = pip_requirements_changed(requirements_pip_paths())
+        if pip_wheelhouse:
+            if not (req_paths or extra_pip_delta) or \
+               not pip_install_wheelhouse(pip_wheelhouse, req_paths,
+                                          extra_pip_delta):
+                pip_requirements_record(req_paths, extra_pip_pkgs)
+        else:
+            for req_path in req_paths:
+                if not pip_install_req(req_path):
+                    pip_requirements_record([req_path])
+
+        precompile(working_dir)
+
+    run_phases({
+        'charm_packages': (upgrade_charm_packages, []),
+        'pip_packages': (upgrade_pip_packages, ['charm_packages']),
+        # git and hg may be replaced by the charm packages upgrade
+        'code': (update_code, ['charm_packages']),
+        'requirements': (upgrade_requirements, ['code', 'pip_packages']),
+    })
+    state_set({'code_release': str(int(time.time()))})
 
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-       relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    request_reload(force=True)
 
     for relid in relation_ids('django-settings'):
        relation_set({'django_settings_timestamp': time.time()}, relation_id=relid)
-    
 
 def django_settings_relation_joined_changed():
     os.environ['DJANGO_SETTINGS_MODULE'] = '.'.join([sanitized_unit_name, 'settings'])
@@ -609,11 +2054,11 @@ def django_settings_relation_joined_changed():
                   'wsgi_group': wsgi_group,
                  })
 
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
+    chown_tree(settings_dir_path)
+    chown_tree(urls_dir_path)
 
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    request_reload()
 
 def django_settings_relation_broken():
     pass
@@ -629,32 +2074,17 @@ def pgsql_relation_joined_changed():
     if not database:
         return
 
-    templ_vars = {
-       'db_engine': 'django.db.backends.postgresql_psycopg2',
-       'db_database': database,
-       'db_user': relation_get("user"),
-       'db_password': relation_get("password"),
-       'db_host': relation_get("host"),
-    }
-
-    process_template('engine.tmpl', templ_vars, settings_database_path % {'engine_name': 'pgsql'})
-
-    run("%s syncdb --noinput --pythonpath=%s --settings=%s || true" % \
-            (django_admin_cmd, install_root, django_settings_modules))
+    changed = write_database_settings()
 
-
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
-
-    # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    # Trigger WSGI reloading, once the leader has migrated the database
+    if migrate_database() and changed:
+        request_reload()
 
 def pgsql_relation_broken():
     run('rm %s' % settings_database_path % {'engine_name': 'pgsql'})
 
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    request_reload()
 
 def mongodb_relation_joined_changed():
     packages = ["python-mongoengine"]
@@ -669,30 +2099,41 @@ def mongodb_relation_joined_changed():
        'db_host': relation_get("host"),
     }
 
-    process_template('mongodb_engine.tmpl', templ_vars, settings_database_path % {'engine_name': 'mongodb'})
-
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
+    changed = process_template('mongodb_engine.tmpl', templ_vars, settings_database_path % {'engine_name': 'mongodb'})
 
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    if changed:
+        request_reload()
 
 def mongodb_relation_broken():
     run('rm %s' % settings_database_path % {'engine_name': 'mongodb'})
 
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    request_reload()
 
-def wsgi_relation_joined_changed():
-    relation_set({'working_dir':working_dir})
+def wsgi_relation_settings():
+    wsgi_settings = {'working_dir': working_dir}
 
     for var in config_data:
         if var.startswith('wsgi_') or var in ['listen_ip', 'port']:
-            relation_set({var: config_data[var]})
-    
+            wsgi_settings[var] = config_data[var]
+
     if not config_data['python_path']:
-        relation_set({'python_path': install_root})
+        if release_mode:
+            wsgi_settings['python_path'] = os.pathsep.join(
+                [install_root, release_site_packages])
+        else:
+            wsgi_settings['python_path'] = install_root
+
+    # A warmed up application can be loaded once by the master and shared by
+    # the workers it forks. A preloading master keeps the old application
+    # across a HUP, so it is left to the gunicorn side, which must restart
+    wsgi_settings['wsgi_preload'] = config_data['warmup']
+    return wsgi_settings
+
+
+def wsgi_relation_joined_changed():
+    relation_set(wsgi_relation_settings())
 
     open_port(config_data['port'])
 
@@ -702,45 +2143,58 @@ def wsgi_relation_broken():
 def cache_relation_joined_changed():
     os.environ['DJANGO_SETTINGS_MODULE'] = django_settings_modules
 
-    packages = ["python-memcache"]
-    apt_get_install(packages)
-
-    host = relation_get("host")
-    if not host:
-        return
-
-    templ_vars = {
-       'cache_engine': 'django.core.cache.backends.memcached.MemcachedCache',
-       'cache_host': relation_get("host"),
-       'cache_port': relation_get("port"),
-    }
-
-    process_template('cache.tmpl', templ_vars, settings_database_path % {'engine_name': 'memcache'})
-
-    run('chown -R %s:%s %s' % (wsgi_user,wsgi_group, working_dir))
-
-
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    if write_cache_settings():
+        request_reload()
 
 def cache_relation_broken():
-    run('rm %s' % settings_database_path % {'engine_name': 'memcache'})
-
     # Trigger WSGI reloading
-    for relid in relation_ids('wsgi'):
-        relation_set({'wsgi_timestamp': time.time()}, relation_id=relid)
+    if write_cache_settings():
+        request_reload()
+
+def website_relation_settings():
+    website_settings = {'port': config_data["port"], 'hostname': get_unit_host()}
+    # Empty values remove the keys from the relation
+    website_settings.update({'static_root': None, 'static_url': None})
+    if config_data['static_collect'] and static_collected():
+        website_settings.update({'static_root': static_current_link,
+                                 'static_url': config_data['static_url']})
+    return website_settings
 
 def website_relation_joined_changed():
-    relation_set({'port': config_data["port"], 'hostname': get_unit_host()})
+    relation_set(website_relation_settings())
 
 def website_relation_broken():
     pass
 
+# One-time tasks run by the leader: name -> function calling leader_task()
+LEADER_TASKS = {
+    'migrations': migrate_database,
+}
+
+def cluster_relation_joined_changed():
+    if is_leader():
+        tokens = {}
+        for name in LEADER_TASKS:
+            if state_get(name + '_token'):
+                tokens[name + '_token'] = state_get(name + '_token')
+        if tokens:
+            leader_publish(tokens)
+
+    # The leader shares the secret key, the others render it
+    if write_secret_settings():
+        request_reload()
+
+    # Reload once the leader caught up, or take over if we are the leader now
+    for name, task in sorted(LEADER_TASKS.items()):
+        if state_get(name + '_waiting') and task():
+            request_reload(force=True)
+
 ###############################################################################
 # Global variables
 ###############################################################################
 config_data = config_get()
+log_threshold = config_data['charm_log_level'].upper()
 juju_log(MSG_DEBUG, "got config: %s" % str(config_data))
 
 django_version = config_data['django_version']
@@ -749,6 +2203,8 @@ repos_url = config_data['repos_url']
 repos_username = config_data['repos_username']
 repos_password = config_data['repos_password']
 repos_branch = config_data['repos_branch']
+vcs_shallow = config_data['vcs_shallow']
+vcs_mirror = config_data['vcs_mirror']
 
 project_template_extension = config_data['project_template_extension']
 project_template_url = config_data['project_template_url']
@@ -756,11 +2212,15 @@ project_template_url = config_data['project_template_url']
 extra_deb_pkgs = config_data['additional_distro_packages']
 extra_pip_pkgs = config_data['additional_pip_packages']
 requirements_pip_files = config_data['requirements_pip_files']
+pip_wheelhouse = config_data['pip_wheelhouse']
 wsgi_user = config_data['wsgi_user']
 wsgi_group = config_data['wsgi_group']
 install_root = config_data['install_root']
 application_path = config_data['application_path']
 django_settings = config_data['django_settings']
+keep_releases = config_data['keep_releases']
+shared_dirs = [d.strip().strip('/') for d in config_data['shared_dirs'].split(',')
+               if d.strip().strip('/')]
 
 unit_name = os.environ['JUJU_UNIT_NAME'].split('/')[0]
 sanitized_unit_name = sanitize(unit_name)
@@ -779,8 +2239,27 @@ settings_dir_path = os.path.join(working_dir, config_data["settings_dir_name"])
 urls_dir_path = os.path.join(working_dir, config_data["urls_dir_name"])
 settings_secret_path = os.path.join(working_dir, config_data["settings_secret_key_path"])
 settings_database_path = os.path.join(working_dir, config_data["settings_database_path"])
+settings_performance_path = os.path.join(working_dir, config_data["settings_performance_path"])
+settings_page_cache_path = os.path.join(working_dir, config_data["settings_page_cache_path"])
+settings_static_path = os.path.join(working_dir, config_data["settings_static_path"])
 hook_name = os.path.basename(sys.argv[0])
 
+git_mirror_dir = os.path.join(install_root, '.%s_mirror.git' % sanitized_unit_name)
+release_mode = keep_releases > 0 and vcs != ''
+releases_dir = vcs_clone_dir + '_releases'
+shared_dir = os.path.join(releases_dir, 'shared')
+current_release_link = os.path.join(releases_dir, 'current')
+static_dir = os.path.join(install_root, sanitized_unit_name + '_static')
+static_current_link = os.path.join(static_dir, 'current')
+release_site_packages = os.path.join(current_release_link, '.venv', 'lib',
+                                     'python%d.%d' % sys.version_info[:2],
+                                     'site-packages')
+if release_mode:
+    # Management commands must see the current release's virtualenv
+    os.environ['PATH'] = os.pathsep.join(
+        [os.path.join(current_release_link, '.venv', 'bin'), os.environ['PATH']])
+    os.environ['PYTHONPATH'] = release_site_packages
+
 ###############################################################################
 # Main section
 ###############################################################################
@@ -792,6 +2271,10 @@ def main():
     elif hook_name == "start":
        start()
 
+    elif hook_name == "update-status":
+        # Only fires the reloads held back by reload_window
+        pass
+
     elif hook_name == "stop":
        stop()
 
@@ -832,11 +2315,14 @@ def main():
     elif hook_name == "wsgi-relation-broken":
         wsgi_relation_broken()
 
-    elif hook_name in ["cache-relation-joined", "cache-relation-changed"]:
+    elif hook_name in ["cache-relation-joined", "cache-relation-changed",
+                       "cache-relation-departed"]:
         cache_relation_joined_changed()
+        config_changed(config_data)
 
     elif hook_name == "cache-relation-broken":
         cache_relation_broken()
+        config_changed(config_data)
 
     elif hook_name in ["website-relation-joined", "website-relation-changed"]:
         website_relation_joined_changed()
@@ -844,11 +2330,21 @@ def main():
     elif hook_name == "website-relation-broken":
         website_relation_broken()
 
+    elif hook_name in ["cluster-relation-joined", "cluster-relation-changed",
+                       "cluster-relation-departed", "leader-elected",
+                       "leader-settings-changed"]:
+        cluster_relation_joined_changed()
+
 
     else:
         print "Unknown hook {}".format(hook_name)
         raise SystemExit(1)
 
+    settings_bundle_flush()
+    ownership_flush()
+    reload_flush()
+    relation_flush()
+
 
 if __name__ == '__main__':
     raise SystemExit(main())